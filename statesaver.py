@@ -1,146 +1,464 @@
-import collections
+import collections.abc
+import contextlib
 import dbm
+import hashlib
+import io
 import json
 import itertools
+import math
 import os
-import pathlib
 import pickle
-from functools import partial, wraps
+import queue
+import struct
+import threading
+import weakref
+from functools import wraps
 try:
     import yaml
 except ImportError:
     yaml = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BUFSIZE = 1024 * 1024
+CHUNKSIZE = 8192
+FRAME = struct.Struct('<I')
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_DONE = object()
+FLOAT_TYPES = frozenset((float,))
+CONTAINER_TYPES = frozenset((dict, list, tuple))
+BYTES_PER_CHECK = 64
 
 
-METHODS = ('__getitem__', '__iter__', '__len__', '__contains__', '__eq__',
-           '__ne__', '__setitem__', '__delitem__')
+def has_nonfinite(obj):
+    """True if obj contains a NaN or infinite float anywhere in its nested
+    dicts, lists and tuples. Each container costs one Python call; its items
+    are only looked at through C-level iterators.
+    """
+    if type(obj) is float:
+        return not math.isfinite(obj)
+    if type(obj) is dict:
+        obj = obj.values()
+    elif type(obj) not in CONTAINER_TYPES:
+        return False
+    types = set(map(type, obj))
+    if float in types and not all(map(math.isfinite, itertools.compress(
+            obj, map(FLOAT_TYPES.__contains__, map(type, obj))))):
+        return True
+    if types.isdisjoint(CONTAINER_TYPES):
+        return False
+    return any(map(has_nonfinite, itertools.compress(
+        obj, map(CONTAINER_TYPES.__contains__, map(type, obj)))))
+
+
+def orjson_default(obj):
+    raise TypeError('Object of type %s is not JSON serializable'
+                    % type(obj).__name__)
+
+
+ORJSON_OPTIONS = 0
+if orjson:
+    ORJSON_OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME
+                      | orjson.OPT_PASSTHROUGH_DATACLASS
+                      | orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+
+def json_dumps(obj, **kwargs):
+    """serialize obj to compact JSON bytes. orjson is used if it is installed
+    and no encoder options are given, with datetimes, dataclasses and
+    subclasses of builtins passed through so they raise TypeError as they
+    do with the json module. Falls back to the json module for anything
+    orjson refuses (non-string keys, huge ints, etc.) and for NaN and
+    infinity, which orjson writes as null. uuid.UUID and Enum values are
+    still written by orjson as their string/value; it has no option to
+    refuse them.
+    """
+    if not kwargs:
+        if orjson:
+            try:
+                data = orjson.dumps(
+                    obj, default=orjson_default, option=ORJSON_OPTIONS)
+            except TypeError:
+                pass
+            else:
+                # NaN and infinity can only hide where orjson wrote null.
+                # Checking for them costs a Python call per container, so
+                # documents made of many small containers go straight to
+                # the json module instead.
+                if b'null' not in data:
+                    return data
+                containers = data.count(b'{') + data.count(b'[')
+                if (containers * BYTES_PER_CHECK <= len(data)
+                        and not has_nonfinite(obj)):
+                    return data
+        kwargs = {'separators': (',', ':')}
+    return json.dumps(obj, **kwargs).encode()
+
+
+def json_encoder(**kwargs):
+    """return a function that serializes to JSON bytes with the given
+    options, building the encoder only once.
+    """
+    if not kwargs:
+        return json_dumps
+    kwargs.setdefault('separators', (',', ':'))
+    cls = kwargs.pop('cls', json.JSONEncoder)
+    encode = cls(**kwargs).encode
+    return lambda obj: encode(obj).encode()
+
+
+def json_decoder(**kwargs):
+    """return a function that deserializes JSON with the given options,
+    building the decoder only once. Decoding always uses the json module:
+    orjson.loads turns integers wider than 64 bits into floats.
+    """
+    if not kwargs:
+        return json.loads
+    cls = kwargs.pop('cls', json.JSONDecoder)
+    decode = cls(**kwargs).decode
+    return lambda data: decode(
+        data.decode() if isinstance(data, bytes) else data)
+
 
+def json_dump(obj, file, **kwargs):
+    file.write(json_dumps(obj, **kwargs).decode())
 
-def get_dummy(name):
-    def dummy_method(self, *args, **kwargs):
-        return getattr(self.state, name)(*args, **kwargs)
-    return dummy_method
 
+def msgpack_loads(data, **kwargs):
+    return msgpack.unpackb(data, **kwargs)
 
-class Loader(type):
-    """Turn load and dump properties into static methods.
-    Add forwarding for some mapping methods.
+
+def msgpack_dump(obj, file, **kwargs):
+    kwargs.setdefault('use_bin_type', True)
+    file.write(msgpack.packb(obj, **kwargs))
+
+
+@contextlib.contextmanager
+def atomic_write(path, fsync=False, compress=False):
+    """open a temporary binary file next to path for writing and move it over
+    path when the block exits without an error, so a crash never leaves a
+    half-written cache behind. With compress, the data is written as a zstd
+    stream.
+    """
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb', buffering=BUFSIZE) as raw:
+            if compress:
+                with zstandard.ZstdCompressor(level=3).stream_writer(
+                        raw, closefd=False) as f:
+                    yield f
+            else:
+                yield raw
+            if fsync:
+                raw.flush()
+                os.fsync(raw.fileno())
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError(
+            'the cache is zstd-compressed; reading it requires the zstandard '
+            'package')
+
+
+def decompress(data):
+    """return data decompressed if it is a zstd stream, otherwise as is"""
+    if data.startswith(ZSTD_MAGIC):
+        require_zstandard()
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def open_cache(path):
+    """open path for reading bytes, decompressing it on the fly if it is a
+    zstd stream.
+    """
+    f = open(path, 'rb', buffering=BUFSIZE)
+    if f.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        try:
+            require_zstandard()
+        except ImportError:
+            f.close()
+            raise
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        return io.BufferedReader(reader, BUFSIZE)
+    return f
+
+
+def frame(data):
+    """prefix data with its length as a 4-byte little-endian integer"""
+    return FRAME.pack(len(data)) + data
+
+
+def read_frames(file):
+    """yield the payloads of the length-prefixed frames in a binary file.
+    Raises ValueError if the file ends in the middle of a frame.
     """
-    def __new__(cls, name, bases, clsdict):
-        for f_name in ('load', 'dump'):
-            if f_name in clsdict:
-                clsdict[f_name] = staticmethod(clsdict[f_name])
+    read, unpack, size = file.read, FRAME.unpack, FRAME.size
+    while True:
+        head = read(size)
+        if not head:
+            return
+        if len(head) < size:
+            raise ValueError('truncated frame header in cache')
+        length, = unpack(head)
+        data = read(length)
+        if len(data) < length:
+            raise ValueError('truncated frame in cache')
+        yield data
+
+
+def prefetcher(iterable, maxsize=64):
+    """iterate over iterable in a background thread, keeping up to maxsize
+    items ready. The thread is started by the first next(), not by the
+    call. Exceptions raised by the iterable are re-raised when the consumer
+    reaches them. This only pays off when producing an item releases the
+    GIL (e.g. reads from slow storage); json decoding does not.
+    """
+    items = queue.Queue(maxsize)
+    error = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            error.append(e)
+        items.put(_DONE)
 
-        for meth in METHODS:
-            if meth not in clsdict:
-                clsdict[meth] = get_dummy(meth)
-        return type.__new__(cls, name, bases, clsdict)
+    threading.Thread(target=produce, daemon=True).start()
+    yield from iter(items.get, _DONE)
+    if error:
+        raise error[0]
 
 
-class Base(metaclass=Loader):
+class Saver:
     def __init__(self, cache_path, erase=False,
-                 load_kwargs=None, dump_kwargs=None):
+                 load_kwargs=None, dump_kwargs=None, fsync=False,
+                 compress=False):
         """Abstract class for for dumping state to disk when the context
-        manager exits and resuming on next run.
+        manager exits and resuming on next run. Set fsync to flush the cache
+        to disk before it replaces the old one, and compress to write it as
+        zstd. Compressed caches are detected automatically when loading.
         """
+        if compress and zstandard is None:
+            raise ImportError('compress=True requires the zstandard package')
         self.load_kwargs = load_kwargs or {}
         self.dump_kwargs = dump_kwargs or {}
-        self.cache_path = pathlib.Path(cache_path)
+        self.cache_path = os.fspath(cache_path)
         self.erase = erase
+        self.fsync = fsync
+        self.compress = compress
         self.prep_state()
 
     def prep_state(self):
-        if self.cache_path.exists():
-            with self.cache_path.open() as c:
-                self.state = self.load(c, **self.load_kwargs)
-        else:
-            self.state = {}
-
-    def __getattr__(self, attr):
-        return getattr(self.state, attr)
+        raise NotImplementedError
 
     def close(self):
-        with self.cache_path.open('w') as c:
-            self.dump(self.state, c, **self.dump_kwargs)
+        raise NotImplementedError
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        if not value and self.erase and self.cache_path.exists():
+        if not value and self.erase and os.path.exists(self.cache_path):
             os.remove(self.cache_path)
         else:
             self.close()
 
 
+class Base(Saver, dict):
+    """A dict that is loaded from a file with `loads` and written back with
+    `dump` when the context manager exits. Subclasses provide both as
+    static methods and set `binary` if `dump` writes bytes.
+    """
+    binary = False
+    _loaded = None
+
+    def prep_state(self):
+        try:
+            with open(self.cache_path, 'rb') as c:
+                data = c.read()
+        except FileNotFoundError:
+            return
+        payload = decompress(data)
+        self.update(self.loads(payload, **self.load_kwargs))
+        # remember a digest of what was on disk so close() can skip an
+        # unchanged rewrite without keeping a copy of the file in memory
+        self._loaded = (hashlib.blake2b(payload).digest(), payload is not data)
+
+    def close(self):
+        buf = io.BytesIO() if self.binary else io.StringIO()
+        self.dump(dict(self), buf, **self.dump_kwargs)
+        payload = buf.getvalue()
+        if not self.binary:
+            payload = payload.encode()
+        digest = hashlib.blake2b(payload).digest()
+        if self._loaded == (digest, bool(self.compress)):
+            return
+        with atomic_write(self.cache_path, self.fsync, self.compress) as c:
+            c.write(payload)
+
+
 class JState(Base):
     """backup to json"""
-    load = json.load
-    dump = json.dump
+    loads = staticmethod(json.loads)
+    dump = staticmethod(json_dump)
 
 
 class YState(Base):
     """backup to safe YAML"""
-    load = yaml.safe_load
-    dump = yaml.safe_dump
+    loads = staticmethod(yaml.safe_load)
+    dump = staticmethod(yaml.safe_dump)
+
+
+class MState(Base):
+    """backup to msgpack"""
+    binary = True
+    loads = staticmethod(msgpack_loads)
+    dump = staticmethod(msgpack_dump)
+
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise ImportError('MState requires the msgpack package')
+        super().__init__(*args, **kwargs)
+
+
+def flush_db(db, pending):
+    for key, val in pending.items():
+        db[key] = val
+    pending.clear()
 
 
-class DBState(Base):
-    def __init__(self, cache_path, erase=False, mode='c', *args, **kwargs):
+def close_db(db, pending):
+    flush_db(db, pending)
+    db.close()
+
+
+class DBState(Saver, collections.abc.MutableMapping):
+    def __init__(self, cache_path, erase=False, mode='c', *args,
+                 flush_every=1024, **kwargs):
         """backup to a unix db that contains json (i.e. like shelve.Shelf, but
-        uses json instead of pickle.
+        uses json instead of pickle. Writes are held in memory and written to
+        the db every `flush_every` assignments, on sync() and on close().
+        Pending writes are also flushed when the object is garbage collected
+        or the interpreter exits, but call close() to be sure.
         """
         self._mode = mode
+        self._pending = {}
+        self.flush_every = flush_every
         super().__init__(cache_path, erase, *args, **kwargs)
+        self._dumps = json_encoder(**self.dump_kwargs)
+        self._loads = json_decoder(**self.load_kwargs)
 
     def prep_state(self):
-        self.state = dbm.open(self.cache_path.name, self._mode)
+        self.state = dbm.open(os.path.basename(self.cache_path), self._mode)
+        self._finalizer = weakref.finalize(
+            self, close_db, self.state, self._pending)
 
     def __setitem__(self, key, val):
-        self.state[key] = json.dumps(
-            val, separators=(':', ','), **self.dump_kwargs)
+        if isinstance(key, str):
+            key = key.encode()
+        self._pending[key] = self._dumps(val)
+        if len(self._pending) >= self.flush_every:
+            self.flush()
 
     def __getitem__(self, item):
-        return json.loads(self.state[item].decode(), **self.load_kwargs)
+        if isinstance(item, str):
+            item = item.encode()
+        try:
+            return self._loads(self._pending[item])
+        except KeyError:
+            return self._loads(self.state[item])
+
+    def __delitem__(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        if self._pending.pop(key, None) is None:
+            del self.state[key]
+        elif key in self.state:
+            del self.state[key]
+
+    def __iter__(self):
+        self.flush()
+        return iter(self.state.keys())
+
+    def __len__(self):
+        self.flush()
+        return len(self.state)
+
+    def flush(self):
+        """write pending items to the db"""
+        flush_db(self.state, self._pending)
+
+    def sync(self):
+        """write pending items and sync the db to disk, if supported"""
+        self.flush()
+        if hasattr(self.state, 'sync'):
+            self.state.sync()
 
     def close(self):
-        self.state.close()
+        self._finalizer()
 
 
 class Looper(JState):
     def __init__(self, cache_path, iterable=None,
-                 cache_first=True, safe=True, **kwargs):
+                 cache_first=True, safe=True, prefetch=False, **kwargs):
         """Wraps an iterable for looping. If the loop is broken, the remaining
-        items in the iterable will be serialized.
+        items in the iterable will be serialized. The safe format is a
+        sequence of length-prefixed JSON documents (see `frame`): the state
+        dict followed by one document per remaining item. With prefetch,
+        a resumed safe cache is read in a background thread (see
+        `prefetcher`).
         """
         self.safe = safe
+        self.read_cache = None
+        self.remaining = None
         super().__init__(cache_path, **kwargs)
-        if safe:
-            self.read_cache = None
-            self.dump_kwargs.setdefault('separators', (',', ':'))
-        if cache_first:
-            try:
-                self.iterable = iter(self.state['remaining'])
-            except KeyError:
-                self.iterable = iter(iterable)
+        if not safe:
+            self.dump_kwargs.setdefault('protocol', pickle.HIGHEST_PROTOCOL)
+        if iterable is None or cache_first and self.remaining is not None:
+            self.iterable = self.remaining
+            if prefetch and self.read_cache:
+                self.iterable = prefetcher(self.remaining)
         else:
-            try:
-                self.iterable = iter(iterable)
-            except TypeError:
-                self.iterable = self.state['remaining']
+            self.iterable = iter(iterable)
 
     def prep_state(self):
-        if self.cache_path.exists():
+        if os.path.exists(self.cache_path):
             if self.safe:
-                load = partial(json.loads, **self.load_kwargs)
-                self.read_cache = self.cache_path.open()
-                self.state = load(self.read_cache.readline())
-                self.state['remaining'] = map(load, self.read_cache)
+                load = json_decoder(**self.load_kwargs)
+                self.read_cache = open_cache(self.cache_path)
+                frames = read_frames(self.read_cache)
+                try:
+                    header = next(frames)
+                except (StopIteration, ValueError):
+                    self.read_cache.close()
+                    raise ValueError('empty or truncated Looper cache: %s'
+                                     % self.cache_path) from None
+                self.update(load(header))
+                self.remaining = map(load, frames)
             else:
-                with self.cache_path.open('rb') as c:
-                    self.state = pickle.load(c, **self.load_kwargs)
-        else:
-            self.state = {}
+                with open_cache(self.cache_path) as c:
+                    state = pickle.load(c, **self.load_kwargs)
+                self.remaining = iter(state.pop('remaining'))
+                self.update(state)
 
     def __exit__(self, type, value, traceback):
         if type:
@@ -149,31 +467,41 @@ class Looper(JState):
             else:
                 self.unsafe_dump()
         else:
-            if self.cache_path.exists():
+            if self.read_cache:
+                self.read_cache.close()
+            if os.path.exists(self.cache_path):
                 os.remove(self.cache_path)
 
     def safe_dump(self):
+        dump = json_encoder(**self.dump_kwargs)
+        try:
+            header = dump(dict(self))
+        except TypeError:
+            print(dict(self))
+            raise
+        with atomic_write(
+                self.cache_path, self.fsync, self.compress) as cache:
+            cache.write(frame(header))
+            while True:
+                chunk = list(itertools.islice(self.iterable, CHUNKSIZE))
+                if not chunk:
+                    break
+                cache.write(b''.join(frame(dump(i)) for i in chunk))
         if self.read_cache:
             self.read_cache.close()
-        if 'remaining' in self.state:
-            del self.state['remaining']
-        with self.cache_path.open('w') as cache:
-            dump = partial(json.dumps, **self.dump_kwargs)
-            try:
-                print(dump(self.state), file=cache)
-            except TypeError:
-                print(self.state)
-                raise
-            print(*(dump(i) for i in self.iterable), sep='\n', file=cache)
 
     def unsafe_dump(self):
-        with self.cache_path.open('wb') as cache:
-            self.state['remaining'] = self.iterable
-            pickle.dump(self.state, cache, **self.dump_kwargs)
+        with atomic_write(
+                self.cache_path, self.fsync, self.compress) as cache:
+            state = dict(self, remaining=self.iterable)
+            pickle.dump(state, cache, **self.dump_kwargs)
 
     def __iter__(self):
+        # not `yield from`, which would close a generator in self.iterable
+        # before __exit__ gets a chance to dump what's left of it.
         with self:
-            yield from self.iterable
+            for i in self.iterable:
+                yield i
 
 
 class PlayQueue(Looper):
@@ -222,44 +550,76 @@ def q(cache):
 
 class FilePos(JState):
     def __init__(self, cache_path, file, *args, **kwargs):
-        """Wrap a file. Remember position when loop breaks."""
-        self.file = file
+        """Wrap a file. Remember position when loop breaks. Binary files on
+        disk are read through a second reader on the same descriptor with a
+        large buffer for faster line iteration; the file object passed in
+        stays usable.
+        """
+        self.source = self.file = file
+        if isinstance(file, (io.BufferedReader, io.RawIOBase)):
+            try:
+                self.file = open(file.fileno(), 'rb', buffering=BUFSIZE,
+                                 closefd=False)
+            except OSError:
+                pass
         super().__init__(cache_path, *args, **kwargs)
-        pos = self.state.get('position', 0)
+        pos = self.get('position', 0)
         self.file.seek(pos)
 
     def __exit__(self, type, value, traceback):
-        if type:
-            self.state['position'] = self.file.tell()
+        if type and not self.source.closed:
+            self['position'] = self.file.tell()
             self.file.close()
+            self.source.close()
 
     def __iter__(self):
+        # not `yield from`, which would close self.file before __exit__ can
+        # record the position.
         with self:
-            yield from self.file
+            for line in self.file:
+                yield line
 
     def __getattr__(self, attr):
         return getattr(self.file, attr)
 
 
 def rewind(file):
-    pos = file.tell()
-    backtrack = 0
-    lines = ()
-    while len(lines) < 2:
-        backtrack += 100
-        byteno = pos-backtrack
-        if byteno < 0:
-            byteno = 0
-            backtrack = pos
-        file.seek(byteno)
-        lines = file.read(backtrack).splitlines()
-    newpos = pos-len(lines[-1])-1
+    """seek back to the beginning of the line that ends at the current
+    position and return the new position. The file must be opened in binary
+    mode, since positions are byte offsets. It is read backwards in chunks
+    that double in size, so each byte is only scanned once.
+    """
+    if isinstance(file, io.TextIOBase):
+        raise TypeError('rewind requires a file opened in binary mode')
+    pos = end = file.tell()
+    size = 256
+    while end > 0:
+        start = max(end - size, 0)
+        file.seek(start)
+        chunk = file.read(end - start)
+        stop = len(chunk)
+        if end == pos and chunk.endswith(b'\n'):
+            stop -= 1
+        idx = chunk.rfind(b'\n', 0, stop)
+        if idx >= 0:
+            newpos = start + idx + 1
+            break
+        end = start
+        size *= 2
+    else:
+        newpos = 0
     file.seek(newpos)
     return newpos
 
 
-def state(cache_path, erase=False, dbm_mode=None):
+FORMATS = {'json': JState, 'yaml': YState, 'msgpack': MState}
+
+
+def state(cache_path, erase=False, dbm_mode=None, fmt='json'):
     if dbm_mode:
         return DBState(cache_path, erase, dbm_mode)
-    else:
-        return JState(cache_path, erase)
+    try:
+        cls = FORMATS[fmt]
+    except KeyError:
+        raise ValueError('unknown format: %r' % fmt) from None
+    return cls(cache_path, erase)
@@ -1,6 +1,17 @@
 #!/usr/bin/env python3
+import dataclasses
+import datetime
+import io
+import os
 import statesaver
 
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
 jstate = statesaver.JState('jcache')
 try:
     print(jstate['foo'])
@@ -9,6 +20,60 @@ except KeyError:
 with jstate:
     jstate['foo'] = 'bar'
 
+# non-finite floats must survive a round trip, alone or alongside values
+# orjson refuses (int keys, huge ints).
+with statesaver.JState('nancache') as nanstate:
+    nanstate['x'] = float('nan')
+    nanstate['inf'] = float('-inf')
+nanstate = statesaver.JState('nancache')
+assert nanstate['x'] != nanstate['x'] and nanstate['inf'] == float('-inf')
+
+with statesaver.JState('mixedcache') as mixed:
+    mixed[1] = float('nan')
+    mixed['big'] = 2**70 + 1
+mixed = statesaver.JState('mixedcache')
+assert mixed['1'] != mixed['1'] and mixed['big'] == 2**70 + 1
+
+# integers wider than 64 bits must come back exactly, not as floats
+with statesaver.JState('bigcache') as big:
+    big['n'] = 2**70 + 1
+assert statesaver.JState('bigcache')['n'] == 2**70 + 1
+
+bigdb = statesaver.DBState('bigdb')
+bigdb['n'] = 2**70 + 1
+bigdb.close()
+bigdb = statesaver.DBState('bigdb')
+assert bigdb['n'] == 2**70 + 1
+bigdb.close()
+
+# None next to a nested NaN: orjson's null must not hide the NaN
+with statesaver.JState('nullnancache') as nullnan:
+    nullnan['x'] = [None, 'y' * 100, {'z': float('inf')}]
+nullnan = statesaver.JState('nullnancache')
+assert nullnan['x'][0] is None and nullnan['x'][2]['z'] == float('inf')
+
+# values the json module refuses must still raise, not be coerced by orjson
+for value in (datetime.datetime(2020, 1, 1), Point(1, 2)):
+    try:
+        statesaver.json_dumps({'v': value})
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('%r was serialized' % (value,))
+
+
+class Stop(Exception):
+    pass
+
+
+try:
+    for i in statesaver.Looper('bigloop', [1, 2**71 + 1, 3]):
+        if i == 1:
+            raise Stop
+except Stop:
+    pass
+assert list(statesaver.Looper('bigloop')) == [2**71 + 1, 3]
+
 
 # more later...
 dbstate = statesaver.DBState('dbcache')
@@ -20,3 +85,180 @@ for i in statesaver.PlayQueue('loopy', range(10)):
 print('here')
 for i in statesaver.PlayQueue('loopy', range(10)):
     print(i)
+
+# FilePos must leave the caller's file object usable
+with open('fposdata', 'w') as f:
+    f.write('a\nbb\nccc\n')
+with open('fposdata', 'rb') as f:
+    lines = iter(statesaver.FilePos('fposcache', f))
+    assert next(lines) == b'a\n'
+    f.seek(0)
+    assert f.read() == b'a\nbb\nccc\n'
+
+# rewind: back to the start of the line ending at the current position
+def rewound(data, pos=None):
+    f = io.BytesIO(data)
+    f.seek(len(data) if pos is None else pos)
+    newpos = statesaver.rewind(f)
+    assert f.tell() == newpos
+    return newpos
+
+
+assert rewound(b'a\nbb\nccc\n') == 5
+assert rewound(b'a\nbb\nccc') == 5
+assert rewound(b'a\nbb\nccc\n', 5) == 2
+assert rewound(b'one line\n') == 0
+assert rewound(b'') == 0
+assert rewound('é'.encode() * 5 + b'\nx\n', 11) == 0
+long_line = b'x' * 5000 + b'\n'
+assert rewound(long_line * 3) == len(long_line) * 2
+try:
+    statesaver.rewind(io.StringIO('a\nb\n'))
+except TypeError:
+    pass
+else:
+    raise AssertionError('rewind accepted a text file')
+
+# JState round trip
+with statesaver.JState('jroundtrip') as jrt:
+    jrt['list'] = [1, 2.5, 'three', None, {'four': True}]
+assert statesaver.JState('jroundtrip') == {
+    'list': [1, 2.5, 'three', None, {'four': True}]}
+
+
+# safe and unsafe Looper: break, resume, break again, finish
+for safe in (True, False):
+    cache = 'looper-%s' % ('safe' if safe else 'unsafe')
+    for stop in (3, 6):
+        try:
+            for i in statesaver.Looper(cache, range(10), safe=safe):
+                if i == stop:
+                    raise Stop
+        except Stop:
+            pass
+    assert list(statesaver.Looper(cache, range(10), safe=safe)) == [7, 8, 9]
+    assert list(statesaver.Looper(cache, range(3), safe=safe)) == [0, 1, 2]
+
+# resuming with a background prefetch thread gives the same items
+try:
+    for i in statesaver.Looper('prefetchloop', range(100)):
+        if i == 10:
+            raise Stop
+except Stop:
+    pass
+resumed = statesaver.Looper('prefetchloop', prefetch=True)
+assert list(resumed) == list(range(11, 100))
+
+# an empty or truncated cache is an error, not a bare StopIteration
+open('emptyloop', 'wb').close()
+try:
+    statesaver.Looper('emptyloop', range(3))
+except ValueError:
+    pass
+else:
+    raise AssertionError('empty Looper cache was accepted')
+
+# DBState encoder options keep the compact separators
+dbopts = statesaver.DBState('dbopts', dump_kwargs={'sort_keys': True})
+dbopts['a'] = {'b': 1, 'a': 2}
+dbopts.flush()
+assert dbopts.state['a'] == b'{"a":2,"b":1}'
+dbopts.close()
+
+# DBState write buffering
+buffered = statesaver.DBState('dbbuffer', flush_every=3)
+buffered['a'] = [1]
+assert buffered['a'] == [1] and b'a' not in buffered.state
+buffered['b'] = 2
+del buffered['b']
+assert 'b' not in buffered
+buffered['c'] = 3
+buffered['d'] = 4
+assert buffered.state[b'a'] == b'[1]' and b'd' in buffered.state
+buffered['e'] = 5
+del buffered  # pending writes are flushed when the object is collected
+buffered = statesaver.DBState('dbbuffer')
+assert dict(buffered.items()) == {b'a': [1], b'c': 3, b'd': 4, b'e': 5}
+buffered.close()
+
+# closing an unchanged state leaves the file alone; a change rewrites it
+with statesaver.JState('unchanged') as unchanged:
+    unchanged['a'] = 1
+inode = os.stat('unchanged').st_ino
+with statesaver.JState('unchanged') as unchanged:
+    pass
+assert os.stat('unchanged').st_ino == inode
+with statesaver.JState('unchanged') as unchanged:
+    unchanged['a'] = 2
+assert os.stat('unchanged').st_ino != inode
+assert statesaver.JState('unchanged')['a'] == 2
+
+# state() factory and the msgpack backend
+with statesaver.state('fmtjson', fmt='json') as fmtjson:
+    fmtjson['a'] = [1, 'two']
+assert type(fmtjson) is statesaver.JState
+assert statesaver.state('fmtjson')['a'] == [1, 'two']
+try:
+    statesaver.state('fmtbad', fmt='xml')
+except ValueError:
+    pass
+else:
+    raise AssertionError('unknown format was accepted')
+
+if statesaver.msgpack:
+    with statesaver.state('mcache', fmt='msgpack') as mstate:
+        mstate['a'] = [1, b'bytes', {'c': 2.5}]
+    mstate = statesaver.MState('mcache')
+    assert mstate['a'] == [1, b'bytes', {'c': 2.5}]
+
+msgpack, statesaver.msgpack = statesaver.msgpack, None
+try:
+    statesaver.MState('mmissing')
+except ImportError:
+    pass
+else:
+    raise AssertionError('MState was built without msgpack')
+finally:
+    statesaver.msgpack = msgpack
+
+# zstd compression
+if statesaver.zstandard:
+    with statesaver.JState('zjcache', compress=True) as zjstate:
+        zjstate['a'] = ['x' * 1000, 2]
+    with open('zjcache', 'rb') as f:
+        assert f.read(4) == statesaver.ZSTD_MAGIC
+    # compressed caches are detected on load whatever the flag says
+    assert statesaver.JState('zjcache')['a'] == ['x' * 1000, 2]
+
+    for safe in (True, False):
+        try:
+            for i in statesaver.Looper('zloop', range(1000), safe=safe,
+                                       compress=True):
+                if i == 10:
+                    raise Stop
+        except Stop:
+            pass
+        with open('zloop', 'rb') as f:
+            assert f.read(4) == statesaver.ZSTD_MAGIC
+        resumed = statesaver.Looper('zloop', safe=safe)
+        assert list(resumed) == list(range(11, 1000))
+
+zstandard, statesaver.zstandard = statesaver.zstandard, None
+try:
+    try:
+        statesaver.JState('zmissing', compress=True)
+    except ImportError:
+        pass
+    else:
+        raise AssertionError('compress=True accepted without zstandard')
+    with open('zfake', 'wb') as f:
+        f.write(statesaver.ZSTD_MAGIC + b'not really zstd')
+    for cls in (statesaver.JState, statesaver.Looper):
+        try:
+            cls('zfake')
+        except ImportError:
+            pass
+        else:
+            raise AssertionError('read a zstd cache without zstandard')
+finally:
+    statesaver.zstandard = zstandard